@@ -1,14 +1,42 @@
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
 import streamlit as st
 import openai
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
-from extraction_functions import call_openai_for_enhanced_metadata
-from db_utils import load_knowledge_db, save_knowledge_db, update_knowledge_db
+from extraction_functions import call_openai_for_enhanced_metadata_batch, is_empty_metadata
+from db_utils import load_knowledge_db, save_knowledge_db, update_knowledge_db, export_knowledge_db
 from graph_utils import visualize_knowledge_graph
+from pdf_utils import extract_text_from_pdf
 
 st.title("特許ナレッジDBアップデート & 可視化デモ")
 
+# 抽出テキストは全セッションで共有されるため、保持件数と期間を限って溜め込まないようにする
+@st.cache_data(
+    show_spinner=False, max_entries=32, ttl=60 * 60,
+    hash_funcs={UploadedFile: lambda f: (f.file_id, f.name, f.size)}
+)
+def read_uploaded_text(uploaded_file):
+    """アップロードファイルからテキストを取り出す（同じファイルは再実行時に再解析しない）"""
+    if uploaded_file.type == "application/pdf":
+        return extract_text_from_pdf(uploaded_file)
+    # 再実行時に読み取り位置が残っているため、先頭に戻してから読む
+    uploaded_file.seek(0)
+    return uploaded_file.read().decode("utf-8")
+
+@st.fragment(run_every=0.5)
+def show_extraction_status():
+    """抽出ジョブの実行中だけ表示する進捗。完了したらアプリ全体を再実行して結果を反映する"""
+    job = st.session_state.get("extraction")
+    if job is None or job["future"].done():
+        st.rerun()
+    with st.status(f"解析中...（{len(job['texts'])} 件）", state="running"):
+        done, total = job["progress"]
+        if total:
+            st.progress(done / total, text=f"チャンクの要約・抽出 {done}/{total}")
+
 # ユーザーにAPIキーを入力させる
 openai_api_key = st.text_input("OpenAI API Key", type="password")
 if not openai_api_key:
@@ -18,37 +46,60 @@ openai.api_key = openai_api_key
 # ナレッジDBの読み込み
 db = load_knowledge_db()
 
-# ファイルアップロード
+# ファイルアップロード（複数可）
 st.subheader("特許文書ファイルをアップロード")
-uploaded_file = st.file_uploader("PDFまたはテキストファイルを選択", type=["pdf", "txt"])
+uploaded_files = st.file_uploader("PDFまたはテキストファイルを選択", type=["pdf", "txt"], accept_multiple_files=True)
 
-if uploaded_file is not None:
-    if uploaded_file.type == "application/pdf":
+if uploaded_files:
+    texts = []
+    for i, uploaded_file in enumerate(uploaded_files):
         try:
-            import pdfplumber
-            with pdfplumber.open(uploaded_file) as pdf:
-                text = "\n".join([page.extract_text() or "" for page in pdf.pages])
+            text = read_uploaded_text(uploaded_file)
         except Exception as e:
-            st.error(f"PDF抽出エラー: {e}")
+            st.error(f"テキスト抽出エラー（{uploaded_file.name}）: {e}")
             text = ""
-    else:
-        text = uploaded_file.read().decode("utf-8")
-    
-    st.subheader("抽出されたテキスト（先頭部分）")
-    st.text_area("テキスト", text[:1000], height=200)
+        texts.append(text)
+
+        st.subheader(f"抽出されたテキスト（先頭部分）: {uploaded_file.name}")
+        st.text_area("テキスト", text[:1000], height=200, key=f"preview_{i}")
     
-    if st.button("メタデータ抽出＆DB更新"):
-        with st.spinner("解析中..."):
-            metadata = call_openai_for_enhanced_metadata(text)
+    if st.button("メタデータ抽出＆DB更新", disabled="extraction" in st.session_state):
+        # OpenAI呼び出しはバックグラウンドスレッドで行い、待機中もUIを操作できるようにする
+        if "executor" not in st.session_state:
+            st.session_state["executor"] = ThreadPoolExecutor(max_workers=1)
+        job = {"texts": texts, "progress": (0, 0)}
+
+        def on_progress(done, total, job=job):
+            # ワーカースレッドから呼ばれる。表示は show_extraction_status が行う
+            job["progress"] = (done, total)
+
+        job["future"] = st.session_state["executor"].submit(
+            call_openai_for_enhanced_metadata_batch, texts, api_key=openai_api_key, on_progress=on_progress
+        )
+        st.session_state["extraction"] = job
+
+job = st.session_state.get("extraction")
+if job is not None and job["future"].done():
+    del st.session_state["extraction"]
+    try:
+        metadata_list = job["future"].result()
+    except Exception as e:
+        st.error(f"メタデータ抽出エラー: {e}")
+    else:
+        for text, metadata in zip(job["texts"], metadata_list):
+            if is_empty_metadata(metadata):
+                st.warning("メタデータを抽出できませんでした（詳細はサーバーログを確認してください）")
             st.json(metadata)
-            updated_db = update_knowledge_db(db, metadata, text)
-            save_knowledge_db(updated_db)
-            st.success("ナレッジDB更新完了")
+            update_knowledge_db(db, metadata, text)
+        save_knowledge_db(db)
+        st.success("ナレッジDB更新完了")
+elif job is not None:
+    show_extraction_status()
 
 st.subheader("ナレッジDB内容の表示")
 if db["documents"]:
-    st.text_area("ナレッジDB", json.dumps(db, ensure_ascii=False, indent=2), height=200)
+    st.text_area("ナレッジDB", orjson.dumps(export_knowledge_db(db), option=orjson.OPT_INDENT_2).decode("utf-8"), height=200)
 
 st.subheader("グラフの可視化")
 if st.button("グラフ表示"):
-    visualize_knowledge_graph(db)
+    visualize_knowledge_graph(db["graph"], db["_graph_version"])
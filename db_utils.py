@@ -1,97 +1,359 @@
-import json
+import hashlib
 import os
+import sqlite3
+import threading
+import unicodedata
+import uuid
+from contextlib import closing
 
+import networkx as nx
+import orjson
+import streamlit as st
+import zstandard as zstd
+
+# 旧形式(全体を1ファイルに書き出すJSON)。初回起動時のみ移行元として読む
 KNOWLEDGE_DB_FILE = "knowledge_db.json"
+KNOWLEDGE_DB_SQLITE = "knowledge_db.sqlite"
+
+# この回数の保存ごとに compact_knowledge_db でファイルを整理する（回数はSQLiteのmetaテーブルに記録する）
+COMPACT_INTERVAL = 100
+
+# load_knowledge_db が返すDBは全セッションで共有されるため、更新・保存を直列化する
+_DB_LOCK = threading.RLock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    json BLOB NOT NULL,
+    fulltext BLOB
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    id TEXT PRIMARY KEY,
+    label TEXT NOT NULL,
+    "group" TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS edges (
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    label TEXT NOT NULL,
+    PRIMARY KEY (source, target, label)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+def _connect():
+    """SQLiteに接続する（WALモードで読み書きを並行可能にする）"""
+    conn = sqlite3.connect(KNOWLEDGE_DB_SQLITE, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    # fulltext列が無い旧スキーマのDBには列を追加する（旧行の全文はjson内に残る）
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(documents)")}
+    if "fulltext" not in columns:
+        conn.execute("ALTER TABLE documents ADD COLUMN fulltext BLOB")
+    return conn
+
+def _document_id(text):
+    """
+    文書ID（全文のSHA-256）。
+    「半導体装置」のようにありふれた発明の名称の別文書が同じIDにならないよう、名称ではなく本文から決める。
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _normalize_key(text):
+    """表記ゆれを吸収した比較用のキー（NFKC正規化 + 前後の空白除去 + casefold）"""
+    return unicodedata.normalize("NFKC", text).strip().casefold()
+
+def _empty_pending():
+    # replaced: 置き換えた文書のID（保存時にその文書から出ている旧エッジを削除する）
+    return {"documents": [], "nodes": [], "edges": [], "replaced": []}
+
+def _build_indexes(db):
+    """
+    nodes/edges からNetworkXのグラフを組み立てる（保存対象外の "_" 始まりキー）。
+    ノードの存在確認・エッジの重複確認はこのグラフに対してO(1)で行う。
+    エッジのキーにはラベルを使い、同一の (source, target, label) は1本にまとめる。
+    """
+    graph = nx.MultiDiGraph()
+    graph.add_nodes_from((n["id"], {"label": n["label"], "group": n["group"]}) for n in db["graph"]["nodes"])
+    graph.add_edges_from((e["source"], e["target"], e["label"], {"label": e["label"]}) for e in db["graph"]["edges"])
+    db["_nx"] = graph
+    # 表記ゆれ（全角/半角・大文字/小文字・前後の空白）を吸収するための 正規化キー→ノードID
+    db["_canonical"] = {}
+    for n in db["graph"]["nodes"]:
+        db["_canonical"].setdefault(_normalize_key(n["id"]), n["id"])
+    # 文書ID→db["documents"]内の位置（同じ文書の再登録時に置き換えるため）
+    db["_doc_index"] = {d["id"]: i for i, d in enumerate(db["documents"])}
+    # グラフの内容が変わるたびに更新するトークン（グラフ描画のキャッシュキーに使う）
+    db["_graph_version"] = uuid.uuid4().hex
+    # 前回保存以降に追加されたレコード（save_knowledge_dbで差分だけ書き込む）
+    db["_pending"] = _empty_pending()
+    return db
+
+def export_knowledge_db(db):
+    """索引などの "_" 始まりのキーを除いた、保存・表示用のdictを返す"""
+    return {k: v for k, v in db.items() if not k.startswith("_")}
+
+def _write_records(conn, documents, nodes, edges, replaced=()):
+    """
+    文書・ノード・エッジを1トランザクションで書き込む。
+    文書の全文(fulltext)はzstdで圧縮して別の列に保存し、jsonには含めない。
+    replaced の文書から出ているエッジは、新しいエッジを書き込む前に削除する。
+    """
+    compressor = zstd.ZstdCompressor(level=3)
+    rows = [
+        (
+            d["id"],
+            orjson.dumps({k: v for k, v in d.items() if k != "fulltext"}),
+            compressor.compress(d.get("fulltext", "").encode("utf-8"))
+        )
+        for d in documents
+    ]
+    conn.execute("BEGIN")
+    try:
+        # 既存の文書は行を置き換えずに更新し、rowid（読み込み時の並び順）を保つ
+        conn.executemany(
+            "INSERT INTO documents (id, json, fulltext) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET json = excluded.json, fulltext = excluded.fulltext",
+            rows
+        )
+        # 置き換えた文書の発明の名称が変わった場合に備え、既存ノードは表示名だけ更新する
+        conn.executemany(
+            'INSERT INTO nodes (id, label, "group") VALUES (?, ?, ?) '
+            "ON CONFLICT(id) DO UPDATE SET label = excluded.label",
+            [(n["id"], n["label"], n["group"]) for n in nodes]
+        )
+        conn.executemany("DELETE FROM edges WHERE source = ?", [(doc_id,) for doc_id in replaced])
+        conn.executemany(
+            "INSERT OR IGNORE INTO edges (source, target, label) VALUES (?, ?, ?)",
+            [(e["source"], e["target"], e["label"]) for e in edges]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _increment_save_count(conn):
+    """
+    保存回数を1増やして返す。
+    プロセスの再起動や外部変更による読み直しでリセットされないよう、メモリではなくSQLiteに記録する。
+    """
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES ('save_count', 1) "
+        "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+    )
+    return conn.execute("SELECT value FROM meta WHERE key = 'save_count'").fetchone()[0]
+
+def _migrate_from_json(conn):
+    """
+    旧形式のknowledge_db.jsonの内容をSQLiteへ移す。
+    旧形式の文書IDは発明の名称のため、同名の別文書が上書きされないよう全文から振り直す。
+    """
+    with open(KNOWLEDGE_DB_FILE, "rb") as f:
+        old_db = orjson.loads(f.read())
+    documents = [{**d, "id": _document_id(d.get("fulltext", ""))} for d in old_db["documents"]]
+    _write_records(conn, documents, old_db["graph"]["nodes"], old_db["graph"]["edges"])
+
+def _storage_mtime():
+    """SQLite本体とWALファイルの最終更新時刻（外部からの変更の検知用）"""
+    paths = (KNOWLEDGE_DB_SQLITE, f"{KNOWLEDGE_DB_SQLITE}-wal")
+    return max((os.stat(p).st_mtime_ns for p in paths if os.path.exists(p)), default=0)
+
+def _read_knowledge_db():
+    """保存済みのナレッジDB(SQLite)を読み込む。初回は旧JSONから移行する"""
+    with closing(_connect()) as conn:
+        # user_version=0 は未移行の新規DB
+        if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            if os.path.exists(KNOWLEDGE_DB_FILE):
+                _migrate_from_json(conn)
+            conn.execute("PRAGMA user_version = 1")
+        documents = [orjson.loads(body) for (body,) in conn.execute("SELECT json FROM documents ORDER BY rowid")]
+        nodes = [
+            {"id": node_id, "label": label, "group": group}
+            for node_id, label, group in conn.execute('SELECT id, label, "group" FROM nodes ORDER BY rowid')
+        ]
+        edges = [
+            {"source": source, "target": target, "label": label}
+            for source, target, label in conn.execute("SELECT source, target, label FROM edges ORDER BY rowid")
+        ]
+    db = {"documents": documents, "graph": {"nodes": nodes, "edges": edges}}
+    db["_mtime"] = _storage_mtime()
+    return _build_indexes(db)
+
+@st.cache_resource(show_spinner=False)
+def _load_shared_knowledge_db():
+    return _read_knowledge_db()
 
 def load_knowledge_db():
-    """保存済みのナレッジDB(JSON)を読み込む"""
-    if os.path.exists(KNOWLEDGE_DB_FILE):
-        with open(KNOWLEDGE_DB_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    else:
-        return {"documents": [], "graph": {"nodes": [], "edges": []}}
+    """
+    ナレッジDBを読み込む。
+    読み込んだDBはサーバーのメモリに保持して再実行・セッション間で共有し、
+    ファイルがこのプロセス以外で更新された場合のみ読み直す。
+    """
+    db = _load_shared_knowledge_db()
+    if db["_mtime"] != _storage_mtime():
+        _load_shared_knowledge_db.clear()
+        db = _load_shared_knowledge_db()
+    return db
 
 def save_knowledge_db(db):
-    """ナレッジDBをJSON形式で保存"""
-    with open(KNOWLEDGE_DB_FILE, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+    """
+    ナレッジDBをSQLiteに保存する。
+    前回保存以降に追加された文書・ノード・エッジだけを書き込む。
+    """
+    with _DB_LOCK:
+        pending = db.get("_pending")
+        if pending is None:
+            # 索引を持たないdictは全件を書き込む
+            pending = {
+                "documents": db["documents"], "nodes": db["graph"]["nodes"], "edges": db["graph"]["edges"],
+                "replaced": []
+            }
+        with closing(_connect()) as conn:
+            _write_records(conn, pending["documents"], pending["nodes"], pending["edges"], pending["replaced"])
+            save_count = _increment_save_count(conn)
+        # 保存済みの全文はメモリに保持せず、必要な時に get_fulltext で読み出す
+        for doc in pending["documents"]:
+            doc.pop("fulltext", None)
+        db["_pending"] = _empty_pending()
+        if save_count % COMPACT_INTERVAL == 0:
+            compact_knowledge_db()
+        # 自身の書き込みで共有DBが読み直されないよう、保存後の時刻を記録する
+        db["_mtime"] = _storage_mtime()
+
+def compact_knowledge_db():
+    """
+    WALの内容を本体に書き戻してWALファイルを切り詰め、
+    文書の置き換え等で生じた空き領域をVACUUMで詰める。
+    """
+    with _DB_LOCK, closing(_connect()) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+
+def get_fulltext(doc):
+    """文書の全文を返す（保存済みの文書はSQLiteから読み出して展開する）"""
+    if "fulltext" in doc:
+        return doc["fulltext"]
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT fulltext FROM documents WHERE id = ?", (doc["id"],)).fetchone()
+    if row is None or row[0] is None:
+        return ""
+    return zstd.ZstdDecompressor().decompress(row[0]).decode("utf-8")
+
+def _add_node(db, node_id, group, label=None):
+    """未登録のノードのみ追加し、エッジに使うノードIDを返す（label の省略時はIDを表示名にする）"""
+    if node_id not in db["_nx"]:
+        label = label or node_id
+        node = {"id": node_id, "label": label, "group": group}
+        db["graph"]["nodes"].append(node)
+        db["_nx"].add_node(node_id, label=label, group=group)
+        db["_canonical"].setdefault(_normalize_key(node_id), node_id)
+        db["_pending"]["nodes"].append(node)
+    elif label is not None and db["_nx"].nodes[node_id]["label"] != label:
+        # 置き換えた文書の発明の名称が変わった場合は表示名を更新する
+        db["_nx"].nodes[node_id]["label"] = label
+        node = next(n for n in db["graph"]["nodes"] if n["id"] == node_id)
+        node["label"] = label
+        db["_pending"]["nodes"].append(node)
+    return node_id
+
+def _remove_document_edges(db, doc_id):
+    """
+    置き換える文書から出ているエッジ（発明者・キーワード・用語）を取り除く。
+    再登録した文書のエッジを張り直す前に呼び、旧版のエッジが残らないようにする。
+    SQLite上のエッジは次回の保存時に削除する。
+    """
+    graph = db["_nx"]
+    graph.remove_edges_from(list(graph.out_edges(doc_id, keys=True)))
+    db["graph"]["edges"] = [e for e in db["graph"]["edges"] if e["source"] != doc_id]
+    pending = db["_pending"]
+    pending["edges"] = [e for e in pending["edges"] if e["source"] != doc_id]
+    pending["replaced"].append(doc_id)
+
+def _add_nodes_edges(db, terms, group, source_id, edge_label):
+    """
+    キーワード・発明者・用語(terms)のノードを追加し、source_id からのエッジを張る。
+    表記ゆれだけが異なる既存ノードがあれば新しいノードは作らずそれにつなぎ、
+    同一の (source, target, label) のエッジは重複して追加しない。
+    1文書で数百語を処理するため、参照するdict・リストはループの外で取り出しておく。
+    """
+    graph = db["_nx"]
+    canonical = db["_canonical"]
+    nodes, edges = db["graph"]["nodes"], db["graph"]["edges"]
+    pending = db["_pending"]
+    for term in terms:
+        key = _normalize_key(term)
+        node_id = canonical.get(key)
+        if node_id is None:
+            node_id = term.strip()
+            if node_id not in graph:
+                node = {"id": node_id, "label": node_id, "group": group}
+                nodes.append(node)
+                graph.add_node(node_id, label=node_id, group=group)
+                pending["nodes"].append(node)
+            canonical.setdefault(key, node_id)
+        if not graph.has_edge(source_id, node_id, key=edge_label):
+            edge = {"source": source_id, "target": node_id, "label": edge_label}
+            edges.append(edge)
+            graph.add_edge(source_id, node_id, key=edge_label, label=edge_label)
+            pending["edges"].append(edge)
 
 def update_knowledge_db(db, metadata, original_text):
     """
     抽出されたメタデータをもとに、ナレッジDBに新たな特許文書の情報を追加する。
-    発明の名称を中心ノードとして、各情報（発明者、先行技術文献、用語定義など）を登録する。
-    """
-    title = metadata.get("title", "")
-    if not title:
-        title = f"doc_{len(db['documents'])+1}"
-    doc_entry = {
-        "id": title,
-        "title": title,
-        "technical_field": metadata.get("technical_field", ""),
-        "background_art": metadata.get("background_art", ""),
-        "prior_art_documents": metadata.get("prior_art_documents", []),
-        "problems_to_be_solved": metadata.get("problems_to_be_solved", ""),
-        "means_for_solving": metadata.get("means_for_solving", ""),
-        "effects": metadata.get("effects", ""),
-        "brief_description_of_drawings": metadata.get("brief_description_of_drawings", ""),
-        "embodiments": metadata.get("embodiments", ""),
-        "claims": metadata.get("claims", []),
-        "additional_info": metadata.get("additional_info", {}),
-        "terminologies": metadata.get("terminologies", {}),
-        "fulltext": original_text
-    }
-    db["documents"].append(doc_entry)
-    
-    # 中心ノードとしてタイトル（発明の名称）を登録
-    if title not in [n["id"] for n in db["graph"]["nodes"]]:
-        db["graph"]["nodes"].append({
-            "id": title,
-            "label": title,
-            "group": "document"
-        })
-    
-    # 発明者（additional_info内の inventors）のノード追加
-    inventors = metadata.get("additional_info", {}).get("inventors", [])
-    for inventor in inventors:
-        if inventor not in [n["id"] for n in db["graph"]["nodes"]]:
-            db["graph"]["nodes"].append({
-                "id": inventor,
-                "label": inventor,
-                "group": "inventor"
-            })
-        db["graph"]["edges"].append({
-            "source": title,
-            "target": inventor,
-            "label": "HAS_INVENTOR"
-        })
-    
-    # 先行技術文献と請求項をキーワードとして追加
-    keywords = metadata.get("prior_art_documents", []) + metadata.get("claims", [])
-    for kw in keywords:
-        if kw not in [n["id"] for n in db["graph"]["nodes"]]:
-            db["graph"]["nodes"].append({
-                "id": kw,
-                "label": kw,
-                "group": "keyword"
-            })
-        db["graph"]["edges"].append({
-            "source": title,
-            "target": kw,
-            "label": "HAS_KEYWORD"
-        })
-    
-    # 用語定義の追加（terminologies）
-    terminologies = metadata.get("terminologies", {})
-    for term in terminologies.keys():
-        if term not in [n["id"] for n in db["graph"]["nodes"]]:
-            db["graph"]["nodes"].append({
-                "id": term,
-                "label": term,
-                "group": "terminology"
-            })
-        db["graph"]["edges"].append({
-            "source": title,
-            "target": term,
-            "label": "HAS_TERMINOLOGY"
-        })
+    文書を中心ノード（表示名は発明の名称）として、各情報（発明者、先行技術文献、用語定義など）を登録する。
+    文書は全文のハッシュで識別し、同じ全文の文書が既にあれば置き換える（旧版のエッジは削除する）。
+    ノード・エッジは重複させずに追加する。
+    """
+    with _DB_LOCK:
+        if "_nx" not in db:
+            _build_indexes(db)
+        title = metadata.get("title", "")
+        if not title:
+            title = f"doc_{len(db['documents'])+1}"
+        doc_id = _document_id(original_text)
+        doc_entry = {
+            "id": doc_id,
+            "title": title,
+            "technical_field": metadata.get("technical_field", ""),
+            "background_art": metadata.get("background_art", ""),
+            "prior_art_documents": metadata.get("prior_art_documents", []),
+            "problems_to_be_solved": metadata.get("problems_to_be_solved", ""),
+            "means_for_solving": metadata.get("means_for_solving", ""),
+            "effects": metadata.get("effects", ""),
+            "brief_description_of_drawings": metadata.get("brief_description_of_drawings", ""),
+            "embodiments": metadata.get("embodiments", ""),
+            "claims": metadata.get("claims", []),
+            "additional_info": metadata.get("additional_info", {}),
+            "terminologies": metadata.get("terminologies", {}),
+            "fulltext": original_text
+        }
+        # 同じ文書を再度アップロードした場合は追記せず、既存の文書を置き換える
+        doc_index = db["_doc_index"].get(doc_id)
+        if doc_index is None:
+            db["_doc_index"][doc_id] = len(db["documents"])
+            db["documents"].append(doc_entry)
+        else:
+            db["documents"][doc_index] = doc_entry
+            _remove_document_edges(db, doc_id)
+        db["_pending"]["documents"].append(doc_entry)
+
+        # 中心ノードとして文書を登録（表示名は発明の名称）
+        _add_node(db, doc_id, "document", label=title)
+
+        # 発明者（additional_info内の inventors）のノード追加
+        inventors = metadata.get("additional_info", {}).get("inventors", [])
+        _add_nodes_edges(db, inventors, "inventor", doc_id, "HAS_INVENTOR")
+
+        # 先行技術文献と請求項をキーワードとして追加
+        keywords = metadata.get("prior_art_documents", []) + metadata.get("claims", [])
+        _add_nodes_edges(db, keywords, "keyword", doc_id, "HAS_KEYWORD")
+
+        # 用語定義の追加（terminologies）
+        terminologies = metadata.get("terminologies", {})
+        _add_nodes_edges(db, terminologies.keys(), "terminology", doc_id, "HAS_TERMINOLOGY")
+
+        db["_graph_version"] = uuid.uuid4().hex
     return db
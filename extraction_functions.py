@@ -1,50 +1,225 @@
-import json
+import asyncio
+import functools
+import hashlib
+import logging
+import os
 import re
 import openai
-import streamlit as st
+from openai import AsyncOpenAI
+import orjson
+from pydantic import BaseModel, ValidationError
+import tiktoken
+
+import llm_cache
+
+logger = logging.getLogger(__name__)
 
 # プロンプト設定を外部JSONファイルから読み込む
-with open("prompts.json", "r", encoding="utf-8") as f:
-    prompts = json.load(f)
+with open("prompts.json", "rb") as f:
+    prompts = orjson.loads(f.read())
 
-CHUNK_SIZE = prompts.get("chunk_size", 500)
-OVERLAP = prompts.get("overlap", 100)
-MODEL = prompts.get("model", "gpt-3.5-turbo")
+# OpenAIに送るチャンクはトークン数で区切る（日本語は文字数とトークン数の比が一定でないため）
+CHUNK_TOKENS = prompts.get("chunk_tokens", 500)
+OVERLAP_TOKENS = prompts.get("overlap_tokens", 100)
+MODEL = prompts.get("model", "gpt-4o-mini")
 MAX_TOKENS_SINGLE = prompts.get("max_tokens_single", 3000)
-MAX_TOKENS_PARTIAL = prompts.get("max_tokens_partial", 300)
+MAX_TOKENS_PARTIAL = prompts.get("max_tokens_partial", 200)
+# 部分要約は1段落なので、空行やコードブロックが始まったら生成を打ち切る
+PARTIAL_SUMMARY_STOP = ["\n\n", "```"]
+# 1リクエストでまとめて要約するチャンク数（1ならチャンクごとに要求する）
+PARTIAL_SUMMARY_BATCH_SIZE = prompts.get("partial_summary_batch_size", 8)
 MAX_TOKENS_FINAL = prompts.get("max_tokens_final", 3000)
 TEMPERATURE = prompts.get("temperature", 0.2)
+# プロンプトを変更したら prompts.json の prompt_version を上げてキャッシュを無効化する
+PROMPT_VERSION = prompts.get("prompt_version", 1)
+
+# OpenAIに送る本文の上限トークン数（超える分は重要セクション優先で切り詰める）
+MAX_INPUT_TOKENS = prompts.get("max_input_tokens", 6000)
+
+# 最終抽出に渡す部分要約の合計がこのトークン数を超える場合は、
+# MERGE_FANOUT 件ずつ要約し直して（木構造に）まとめてから最終抽出する。
+# 本文は MAX_INPUT_TOKENS に切り詰め済みで部分要約の合計はそれより短いため、既定値（=MAX_INPUT_TOKENS）では
+# 統合は行われない。max_combined_tokens を小さく設定した場合にだけ働く（MAX_INPUT_TOKENS を上限とする）
+MAX_COMBINED_TOKENS = min(prompts.get("max_combined_tokens", MAX_INPUT_TOKENS), MAX_INPUT_TOKENS)
+# 1件ずつでは要約が減らず終わらないため、2件以上ずつまとめる
+MERGE_FANOUT = max(2, prompts.get("merge_fanout", 4))
+
+# 複数文書を同時に処理する際の同時実行数の上限（レート制限対策）
+MAX_CONCURRENCY = prompts.get("max_concurrency", 8)
+
+# 部分要約などのAPIリクエストを同時に送る数の上限（全文書で共有）
+MAX_PARALLEL_REQUESTS = prompts.get("max_parallel_requests", 10)
+
+# レート制限(429)・タイムアウト・5xxエラー時の再試行回数と、1リクエストのタイムアウト（秒）
+# (再試行の待機はOpenAIクライアントが指数バックオフで行い、Retry-Afterヘッダーにも従う)
+MAX_RETRIES = prompts.get("max_retries", 5)
+REQUEST_TIMEOUT = prompts.get("request_timeout", 120)
+
+# Trueの場合、部分要約をBatch API（料金半額・完了まで最大24時間）でまとめて要求する
+USE_BATCH_API = prompts.get("use_batch_api", False)
+# Batch APIの完了確認の間隔（秒）。確認のたびに倍にし、上限で頭打ちにする
+BATCH_POLL_INITIAL_INTERVAL = 10
+BATCH_POLL_MAX_INTERVAL = 300
+
+# OpenAI APIの応答キャッシュ(llm_cache)の有効期間
+LLM_CACHE_TTL_SECONDS = prompts.get("llm_cache_ttl_days", 30) * 24 * 60 * 60
+
+# 抽出結果(メタデータ)のディスクキャッシュ置き場
+OPENAI_CACHE_DIR = "openai_cache"
+
+# システムプロンプトと指示文(*_PROMPT)は全リクエストでバイト単位で同一に保ち、
+# 可変の本文は最後の別メッセージで渡す（OpenAIの自動プロンプトキャッシュを効かせるため）
+SYSTEM_PROMPT = prompts.get("system_prompt", "あなたは優秀な特許アナリストです。")
+SUMMARY_SYSTEM_PROMPT = prompts.get("summary_system_prompt", "あなたは優秀な要約アナリストです。")
 
 SINGLE_CHUNK_PROMPT = prompts.get("single_chunk_prompt")
 FINAL_CHUNK_PROMPT = prompts.get("final_chunk_prompt")
 PARTIAL_SUMMARY_PROMPT = prompts.get("partial_summary_prompt")
+BATCHED_PARTIAL_SUMMARY_PROMPT = prompts.get("batched_partial_summary_prompt")
 
-def split_text_with_overlap(text, chunk_size=CHUNK_SIZE, overlap=OVERLAP):
-    """テキストを指定のチャンクサイズとオーバーラップで分割する"""
-    chunks = []
-    start = 0
-    n = len(text)
-    while start < n:
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start += (chunk_size - overlap)
-    return chunks
-
-def _extract_json_from_string(text: str):
-    """LLMの出力からJSON部分のみを抽出してパースする"""
-    pattern = r"```json\s*(.*?)\s*```"
-    match = re.search(pattern, text, flags=re.DOTALL)
-    if match:
-        code_block = match.group(1).strip()
-        try:
-            return json.loads(code_block)
-        except Exception:
-            pass
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    """MODEL用のtiktokenエンコーディング（初回利用時に一度だけ読み込む）"""
     try:
-        return json.loads(text)
-    except Exception as e:
-        st.error(f"JSONパース失敗: {e}")
-        return _empty_metadata()
+        return tiktoken.encoding_for_model(MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+# 特許明細書の見出し（セクションの区切りとして使う）
+_SECTION_HEADING_RE = re.compile(
+    r"【(書類名|発明の名称|要約|特許請求の範囲|発明の詳細な説明|技術分野|背景技術|先行技術文献|発明の概要|"
+    r"発明が解決しようとする課題|課題を解決するための手段|発明の効果|図面の簡単な説明|"
+    r"発明を実施するための形態|実施例|産業上の利用可能性|符号の説明)】"
+)
+# トークン数が上限を超える場合に残すセクション（この順に上限まで割り当て、出力は本文中の順序に戻す）
+# 名称・技術分野・先行技術文献は短く、title/technical_field/prior_art_documents の抽出に必要なため先に残す
+_PRIORITY_SECTIONS = (
+    "発明の名称", "要約", "技術分野", "先行技術文献", "発明の効果",
+    "課題を解決するための手段", "特許請求の範囲", "発明を実施するための形態"
+)
+# 最初の見出しより前の書誌事項（発行日・発明者・出願日など）に割り当てる上限（max_tokensに対する割合）
+_HEAD_TOKEN_SHARE = 0.25
+
+def _cut_to_tokens(encoding, ids, max_tokens):
+    """
+    トークン列 ids の先頭 max_tokens トークンぶんの文字列を返す。
+    split_text_by_tokens と同じく文字位置で切るため、複数トークンにまたがる文字が途中で切れることはない。
+    """
+    text, offsets = encoding.decode_with_offsets(ids)
+    if len(ids) <= max_tokens:
+        return text
+    return text[:offsets[max_tokens]]
+
+def _truncate_to_token_budget(text: str, max_tokens=MAX_INPUT_TOKENS):
+    """
+    本文を max_tokens トークン以内に収める。
+    超える場合は、冒頭の書誌事項（最初の見出しより前、上限の1/4まで）を必ず残し、
+    残りを【発明の名称】【要約】【技術分野】等の重要セクションに優先順で割り当てる。
+    見出しが見つからない場合は先頭から切り詰める。
+    """
+    encoding = _get_encoding()
+    ids = encoding.encode(text)
+    total_tokens = len(ids)
+    if total_tokens <= max_tokens:
+        return text
+
+    matches = list(_SECTION_HEADING_RE.finditer(text))
+    sections = {}
+    for m, next_m in zip(matches, matches[1:] + [None]):
+        end = next_m.start() if next_m else len(text)
+        sections.setdefault(m.group(1), (m.start(), text[m.start():end]))
+    if not any(name in sections for name in _PRIORITY_SECTIONS):
+        truncated = _cut_to_tokens(encoding, ids, max_tokens)
+    else:
+        head_ids = encoding.encode(text[:matches[0].start()])
+        head_tokens = min(len(head_ids), int(max_tokens * _HEAD_TOKEN_SHARE))
+        parts = [_cut_to_tokens(encoding, head_ids, head_tokens)] if head_tokens else []
+        remaining = max_tokens - head_tokens
+        kept = []
+        for name in _PRIORITY_SECTIONS:
+            if name not in sections:
+                continue
+            remaining -= 1  # 区切りの改行分
+            if remaining <= 0:
+                break
+            position, section = sections[name]
+            section_ids = encoding.encode(section)
+            kept.append((position, _cut_to_tokens(encoding, section_ids, remaining)))
+            remaining -= min(len(section_ids), remaining)
+        parts.extend(section for _, section in sorted(kept))
+        truncated = "\n".join(parts)
+
+    kept_tokens = len(encoding.encode(truncated))
+    logger.info("入力を %d トークンに切り詰めました（%d トークンを省略）", kept_tokens, total_tokens - kept_tokens)
+    return truncated
+
+def split_text_by_tokens(text, max_tokens=CHUNK_TOKENS, overlap_tokens=OVERLAP_TOKENS):
+    """
+    テキストを max_tokens トークンずつ、overlap_tokens トークン重複させて分割する。
+    区切りは各トークンの文字位置で決めるため、複数トークンにまたがる文字が途中で切れることはない。
+    """
+    encoding = _get_encoding()
+    ids = encoding.encode(text)
+    if not ids:
+        return []
+    text, offsets = encoding.decode_with_offsets(ids)
+    # 末尾の境界として本文の長さを加え、offsets[start + max_tokens] で終端を引けるようにする
+    offsets.append(len(text))
+    n = len(ids)
+    return [
+        text[offsets[start]:offsets[min(start + max_tokens, n)]]
+        for start in range(0, n, max_tokens - overlap_tokens)
+    ]
+
+class AdditionalInfo(BaseModel):
+    filing_date: str
+    publication_date: str
+    registration_date: str
+    inventors: list[str]
+    applicants: list[str]
+    agents: list[str]
+    priority_info: str
+
+class Terminology(BaseModel):
+    term: str
+    definition: str
+    effect: str
+    role: str
+
+class PatentMetadata(BaseModel):
+    """
+    Structured Outputs でモデルに強制するメタデータのスキーマ。
+    (厳格モードは任意キーのdictを扱えないため、terminologies は配列で受け取る)
+    """
+    title: str
+    technical_field: str
+    background_art: str
+    prior_art_documents: list[str]
+    problems_to_be_solved: str
+    means_for_solving: str
+    effects: str
+    brief_description_of_drawings: str
+    embodiments: str
+    claims: list[str]
+    additional_info: AdditionalInfo
+    terminologies: list[Terminology]
+
+    def to_metadata(self):
+        """update_knowledge_db が扱う従来のdict形式（terminologiesは用語→定義のdict）に変換する"""
+        metadata = self.model_dump()
+        metadata["terminologies"] = {
+            t.term: {"definition": t.definition, "effect": t.effect, "role": t.role}
+            for t in self.terminologies
+        }
+        return metadata
+
+class PartialSummaries(BaseModel):
+    """複数チャンクをまとめて要約する際の応答スキーマ（入力と同じ順序の要約）"""
+    summaries: list[str]
+
+def is_empty_metadata(metadata):
+    """抽出に失敗した(空の)メタデータかどうか"""
+    return metadata == _empty_metadata()
 
 def _empty_metadata():
     return {
@@ -70,68 +245,366 @@ def _empty_metadata():
         "terminologies": {}
     }
 
-def _call_openai_single_chunk_enhanced(chunk_text: str):
-    prompt_text = SINGLE_CHUNK_PROMPT.replace("{chunk_text}", chunk_text)
+def _build_messages(system_prompt, instructions, input_text):
+    """固定部分(システムプロンプト・指示文)を先頭に、可変の本文を最後のメッセージに置く"""
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": instructions},
+        {"role": "user", "content": input_text}
+    ]
+
+async def _parse_patent_metadata(client, instructions: str, input_text: str, max_tokens: int):
+    """
+    Responses API の Structured Outputs で PatentMetadata を生成する。
+    スキーマ検証に失敗した場合のみ、エラー内容を伝えて1回だけ再試行する。
+    同じリクエストの結果はllm_cacheから返す。
+    """
+    messages = _build_messages(SYSTEM_PROMPT, instructions, input_text)
+    request = {
+        "endpoint": "responses.parse",
+        "model": MODEL,
+        "input": messages,
+        "text_format": PatentMetadata.model_json_schema(),
+        "max_output_tokens": max_tokens,
+        "temperature": TEMPERATURE
+    }
+    return await llm_cache.cached_call_async(
+        request, lambda: _request_patent_metadata(client, messages, max_tokens), LLM_CACHE_TTL_SECONDS
+    )
+
+async def _request_patent_metadata(client, messages, max_tokens: int):
+    for attempt in range(2):
+        try:
+            response = await client.responses.parse(
+                model=MODEL,
+                input=messages,
+                text_format=PatentMetadata,
+                max_output_tokens=max_tokens,
+                temperature=TEMPERATURE
+            )
+        except ValidationError as e:
+            if attempt == 1:
+                raise
+            messages = messages + [
+                {"role": "user", "content": f"前回の出力はスキーマに適合しませんでした: {e}\nスキーマに従って出力し直してください。"}
+            ]
+            continue
+        if response.output_parsed is None:
+            raise RuntimeError("メタデータを取得できませんでした（応答が途中で打ち切られたか、拒否されました）")
+        return response.output_parsed.to_metadata()
+
+async def _call_openai_single_chunk_enhanced(client, chunk_text: str):
     try:
-        response = openai.ChatCompletion.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": "あなたは優秀な特許アナリストです。"},
-                {"role": "user", "content": prompt_text}
-            ],
-            max_tokens=MAX_TOKENS_SINGLE,
-            temperature=TEMPERATURE
-        )
-        result_text = response.choices[0].message["content"].strip()
-        return _extract_json_from_string(result_text)
+        return await _parse_patent_metadata(client, SINGLE_CHUNK_PROMPT, "テキスト:\n" + chunk_text, MAX_TOKENS_SINGLE)
     except Exception as e:
-        st.error(f"OpenAI APIエラー（シングルチャンク抽出）: {e}")
+        logger.error("OpenAI APIエラー（シングルチャンク抽出）: %s", e)
         return _empty_metadata()
 
-def _call_openai_partial_summary_enhanced(chunk_text: str):
-    prompt_text = PARTIAL_SUMMARY_PROMPT + "\n" + "テキスト:\n" + chunk_text
+def _partial_summary_request(chunk_text: str):
+    """部分要約のChat Completionsリクエスト本文（通常の呼び出しとBatch APIで共通）"""
+    return {
+        "model": MODEL,
+        "messages": _build_messages(SUMMARY_SYSTEM_PROMPT, PARTIAL_SUMMARY_PROMPT, "テキスト:\n" + chunk_text),
+        "max_tokens": MAX_TOKENS_PARTIAL,
+        "stop": PARTIAL_SUMMARY_STOP,
+        "temperature": TEMPERATURE,
+        # 既定値が変わっても結果(とキャッシュ)が変わらないよう明示する
+        "top_p": 1,
+        "presence_penalty": 0,
+        "frequency_penalty": 0
+    }
+
+async def _cached_chat(client, request):
+    """Chat Completionsを呼び、応答本文を返す（同じリクエストはllm_cacheから返す）"""
+    async def call():
+        response = await client.chat.completions.create(**request)
+        return response.choices[0].message.content
+    return await llm_cache.cached_call_async(request, call, LLM_CACHE_TTL_SECONDS)
+
+async def _call_openai_partial_summary_enhanced(client, chunk_text: str):
     try:
-        response = openai.ChatCompletion.create(
+        return (await _cached_chat(client, _partial_summary_request(chunk_text))).strip()
+    except Exception as e:
+        logger.error("OpenAI APIエラー（部分要約抽出）: %s", e)
+        return ""
+
+async def _call_openai_batched_partial_summaries(client, chunks):
+    """
+    複数チャンクの部分要約を1回のリクエストで生成する（指示文のトークンをチャンク間で共有する）。
+    失敗した場合や要約の数がチャンク数と一致しない場合はNoneを返す。
+    """
+    input_text = "".join(f"---CHUNK {i}---\n{chunk}\n\n" for i, chunk in enumerate(chunks))
+    messages = _build_messages(SUMMARY_SYSTEM_PROMPT, BATCHED_PARTIAL_SUMMARY_PROMPT, input_text)
+    max_tokens = MAX_TOKENS_PARTIAL * len(chunks)
+    request = {
+        "endpoint": "responses.parse",
+        "model": MODEL,
+        "input": messages,
+        "text_format": PartialSummaries.model_json_schema(),
+        "max_output_tokens": max_tokens,
+        "temperature": TEMPERATURE
+    }
+
+    async def call():
+        response = await client.responses.parse(
             model=MODEL,
-            messages=[
-                {"role": "system", "content": "あなたは優秀な要約アナリストです。"},
-                {"role": "user", "content": prompt_text}
-            ],
-            max_tokens=MAX_TOKENS_PARTIAL,
+            input=messages,
+            text_format=PartialSummaries,
+            max_output_tokens=max_tokens,
             temperature=TEMPERATURE
         )
-        return response.choices[0].message["content"].strip()
+        if response.output_parsed is None or len(response.output_parsed.summaries) != len(chunks):
+            return None
+        return response.output_parsed.summaries
+
+    try:
+        summaries = await llm_cache.cached_call_async(request, call, LLM_CACHE_TTL_SECONDS)
     except Exception as e:
-        st.error(f"OpenAI APIエラー（部分要約抽出）: {e}")
-        return ""
+        logger.warning("OpenAI APIエラー（部分要約のまとめ抽出）: %s", e)
+        return None
+    if summaries is None:
+        logger.warning("部分要約のまとめ抽出で要約数が一致しなかったため、チャンクごとに要約し直します")
+        return None
+    return [summary.strip() for summary in summaries]
 
-def _call_openai_final_metadata_enhanced(combined_text: str):
-    prompt_text = FINAL_CHUNK_PROMPT.replace("{combined_text}", combined_text)
+async def _run_partial_summary_batch(client, chunk_lists):
+    """
+    複数文書の部分要約をBatch APIで1つのバッチとして要求し、完了を待つ。
+    chunk_lists は {キー: チャンクのリスト}。戻り値は {キー: 部分要約のリスト}（チャンクと同じ順序）。
+    取得できなかった部分要約は空文字になる。llm_cacheにある部分要約はバッチに含めない。
+    同一のチャンクは文書をまたいでも1件だけ要求する（custom_id はチャンクのハッシュ）。
+    """
+    summaries = {key: [""] * len(chunks) for key, chunks in chunk_lists.items()}
+    # チャンクのハッシュ → (チャンク, 出現位置のリスト)
+    unique_chunks = {}
+    for key, chunks in chunk_lists.items():
+        for i, chunk in enumerate(chunks):
+            unique_chunks.setdefault(_chunk_hash(chunk), (chunk, []))[1].append((key, i))
+
+    def fill(custom_id, summary):
+        for key, i in unique_chunks[custom_id][1]:
+            summaries[key][i] = summary
+
+    requests = {}
+    for custom_id, (chunk, _) in unique_chunks.items():
+        request = _partial_summary_request(chunk)
+        cached = llm_cache.get(llm_cache.request_key(request))
+        if cached is not None:
+            fill(custom_id, cached.strip())
+        else:
+            requests[custom_id] = request
+    if not requests:
+        return summaries
+    lines = [
+        orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": request}).decode("utf-8")
+        for custom_id, request in requests.items()
+    ]
     try:
-        response = openai.ChatCompletion.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": "あなたは優秀な特許アナリストです。"},
-                {"role": "user", "content": prompt_text}
-            ],
-            max_tokens=MAX_TOKENS_FINAL,
-            temperature=TEMPERATURE
+        input_file = await client.files.create(
+            file=("partial_summaries.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
         )
-        result_text = response.choices[0].message["content"].strip()
-        return _extract_json_from_string(result_text)
+        interval = BATCH_POLL_INITIAL_INTERVAL
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, BATCH_POLL_MAX_INTERVAL)
+            batch = await client.batches.retrieve(batch.id)
+        if batch.status != "completed":
+            logger.error("Batch APIエラー（部分要約抽出）: バッチ %s が %s で終了しました", batch.id, batch.status)
+        # 期限切れ・取消でも完了済みのリクエスト分は出力ファイルに含まれる
+        if batch.output_file_id is None:
+            return summaries
+        output = await client.files.content(batch.output_file_id)
+    except Exception as e:
+        logger.error("Batch APIエラー（部分要約抽出）: %s", e)
+        return summaries
+
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        result = orjson.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            logger.error("Batch APIエラー（部分要約抽出）: %s", result.get("error") or response)
+            continue
+        content = response["body"]["choices"][0]["message"]["content"]
+        llm_cache.put(llm_cache.request_key(requests[result["custom_id"]]), content, LLM_CACHE_TTL_SECONDS)
+        fill(result["custom_id"], content.strip())
+    return summaries
+
+async def _call_openai_final_metadata_enhanced(client, combined_text: str):
+    try:
+        return await _parse_patent_metadata(client, FINAL_CHUNK_PROMPT, "テキスト要約一覧:\n" + combined_text, MAX_TOKENS_FINAL)
     except Exception as e:
-        st.error(f"OpenAI APIエラー（最終メタデータ抽出）: {e}")
+        logger.error("OpenAI APIエラー（最終メタデータ抽出）: %s", e)
         return _empty_metadata()
 
-def call_openai_for_enhanced_metadata(text: str):
-    chunks = split_text_with_overlap(text)
+def _chunk_hash(chunk: str):
+    """同一チャンクの判定に使うハッシュ（blake2b, 16バイト）"""
+    return hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).hexdigest()
+
+def _metadata_cache_path(text: str):
+    """(モデル, プロンプト版, 入力上限, 本文) から決まるキャッシュファイルのパスを返す"""
+    body = text.encode("utf-8")
+    hasher = hashlib.sha256(f"{MODEL}|{PROMPT_VERSION}|{MAX_INPUT_TOKENS}|".encode("utf-8"))
+    # 本文の前に8バイトの長さを入れ、区切りの曖昧さによる衝突を防ぐ
+    hasher.update(len(body).to_bytes(8, "big"))
+    hasher.update(body)
+    return os.path.join(OPENAI_CACHE_DIR, f"{hasher.hexdigest()}.json")
+
+def _load_cached_metadata(path):
+    """キャッシュ済みメタデータを読み込む。無い/壊れている/項目不足の場合はNone"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            metadata = orjson.loads(f.read())
+    except Exception:
+        return None
+    if not isinstance(metadata, dict) or not set(_empty_metadata()) <= set(metadata):
+        return None
+    return metadata
+
+def _save_cached_metadata(path, metadata):
+    """一時ファイルに書いてから置き換え、途中書き込みのキャッシュを残さない"""
+    os.makedirs(OPENAI_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(metadata))
+    os.replace(tmp_path, path)
+
+def call_openai_for_enhanced_metadata(text: str, api_key=None, on_progress=None):
+    """1文書分のメタデータを抽出する（call_openai_for_enhanced_metadata_batchの1件版）"""
+    return call_openai_for_enhanced_metadata_batch([text], api_key=api_key, on_progress=on_progress)[0]
+
+def call_openai_for_enhanced_metadata_batch(texts, api_key=None, on_progress=None):
+    """
+    複数文書のメタデータを、最大 MAX_CONCURRENCY 件ずつ並行して抽出する。
+    各文書の部分要約も並行して要求し、APIリクエストの同時数は MAX_PARALLEL_REQUESTS までとする。
+    同じ本文(モデル・プロンプト版も同一)の抽出結果がキャッシュにあればAPIを呼ばずに返す。
+    抽出に失敗した結果(空のメタデータ)はキャッシュしない。
+    戻り値は texts と同じ順序のメタデータのリスト。
+    Streamlitに依存しないため、バックグラウンドスレッドからも呼び出せる。
+    api_key を省略した場合は openai.api_key を使う。
+    on_progress を渡すと、チャンクの要約・抽出が終わるごとに on_progress(完了数, 総数) を呼ぶ。
+    prompts.json の use_batch_api が true の場合、部分要約はBatch APIでまとめて要求する
+    （最終抽出は通常どおり呼び出す）。
+    """
+    return asyncio.run(_extract_batch(texts, api_key or openai.api_key, on_progress))
+
+async def _extract_batch(texts, api_key, on_progress=None):
+    results = [None] * len(texts)
+    # キャッシュに無い文書を、同一本文ごとにまとめて1回だけ抽出する
+    pending = {}
+    for i, text in enumerate(texts):
+        cache_path = _metadata_cache_path(text)
+        metadata = _load_cached_metadata(cache_path)
+        if metadata is not None:
+            results[i] = metadata
+        else:
+            pending.setdefault(cache_path, []).append(i)
+    if not pending:
+        return results
+
+    chunks_by_path = {
+        path: split_text_by_tokens(_truncate_to_token_budget(texts[indices[0]]))
+        for path, indices in pending.items()
+    }
+    # 進捗の総数は 処理するチャンク数 + 最終抽出の回数（1チャンクの文書は単独抽出の1回のみ）
+    progress = {"done": 0, "total": sum(len(c) + (len(c) > 1) for c in chunks_by_path.values())}
+
+    def report():
+        progress["done"] += 1
+        if on_progress is not None:
+            on_progress(progress["done"], progress["total"])
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    request_slots = asyncio.Semaphore(MAX_PARALLEL_REQUESTS)
+    async with AsyncOpenAI(api_key=api_key, max_retries=MAX_RETRIES, timeout=REQUEST_TIMEOUT) as client:
+        batch_summaries = {}
+        if USE_BATCH_API:
+            multi_chunks = {path: chunks for path, chunks in chunks_by_path.items() if len(chunks) > 1}
+            if multi_chunks:
+                batch_summaries = await _run_partial_summary_batch(client, multi_chunks)
+                for _ in range(sum(len(c) for c in multi_chunks.values())):
+                    report()
+
+        async def extract_one(cache_path, indices):
+            async with semaphore:
+                metadata = await _extract_enhanced_metadata(
+                    client, chunks_by_path[cache_path], request_slots, report, batch_summaries.get(cache_path)
+                )
+            if not is_empty_metadata(metadata):
+                _save_cached_metadata(cache_path, metadata)
+            for i in indices:
+                results[i] = metadata
+
+        await asyncio.gather(*(extract_one(path, indices) for path, indices in pending.items()))
+    return results
+
+async def _hierarchical_merge(client, summaries, limited, fanout=MERGE_FANOUT):
+    """
+    部分要約の合計が MAX_COMBINED_TOKENS を超える間、fanout 件ずつ連結して要約し直す。
+    各段のグループは並行して要求し、順序は保つ。1件になった場合もそこで終える。
+    """
+    fanout = max(2, fanout)
+    encoding = _get_encoding()
+    while len(summaries) > 1 and len(encoding.encode("\n".join(summaries))) > MAX_COMBINED_TOKENS:
+        groups = [summaries[i:i + fanout] for i in range(0, len(summaries), fanout)]
+        summaries = await asyncio.gather(
+            *(limited(_call_openai_partial_summary_enhanced(client, "\n\n".join(group))) for group in groups)
+        )
+        summaries = list(summaries)
+    return summaries
+
+async def _extract_enhanced_metadata(client, chunks, request_slots, report, partial_summaries=None):
+    """
+    チャンク分割済みの1文書からメタデータを抽出する（部分要約は並行して要求し、順序は保つ）。
+    部分要約は PARTIAL_SUMMARY_BATCH_SIZE チャンクずつ1リクエストにまとめ、
+    まとめた要約に失敗したグループだけチャンクごとに要求し直す。
+    同一のチャンクは1回だけ要約する。
+    partial_summaries を渡した場合(Batch APIで取得済み)は部分要約を要求しない。
+    """
+    async def limited(coro):
+        async with request_slots:
+            return await coro
+
+    async def summarize_group(group):
+        summaries = None
+        if len(group) > 1:
+            summaries = await limited(_call_openai_batched_partial_summaries(client, group))
+        if summaries is None:
+            summaries = await asyncio.gather(
+                *(limited(_call_openai_partial_summary_enhanced(client, chunk)) for chunk in group)
+            )
+        for _ in group:
+            report()
+        return summaries
+
     if len(chunks) == 1:
-        return _call_openai_single_chunk_enhanced(chunks[0])
+        metadata = await limited(_call_openai_single_chunk_enhanced(client, chunks[0]))
+        report()
+        return metadata
     else:
-        partial_summaries = []
-        for i, chunk in enumerate(chunks):
-            with st.spinner(f"チャンク {i+1}/{len(chunks)} を処理中..."):
-                summary = _call_openai_partial_summary_enhanced(chunk)
-                partial_summaries.append(summary)
+        if partial_summaries is None:
+            # 同一のチャンクは1回だけ要約し、結果を元の並びに戻す
+            hashes = [_chunk_hash(chunk) for chunk in chunks]
+            unique_chunks = dict(zip(hashes, chunks))
+            unique_list = list(unique_chunks.values())
+            for _ in range(len(chunks) - len(unique_list)):
+                report()
+            batch_size = max(1, PARTIAL_SUMMARY_BATCH_SIZE)
+            groups = [unique_list[i:i + batch_size] for i in range(0, len(unique_list), batch_size)]
+            group_summaries = await asyncio.gather(*(summarize_group(group) for group in groups))
+            results = dict(zip(unique_chunks, (summary for summaries in group_summaries for summary in summaries)))
+            partial_summaries = [results[h] for h in hashes]
+        partial_summaries = await _hierarchical_merge(client, list(partial_summaries), limited)
         combined_text = "\n".join(partial_summaries)
-        return _call_openai_final_metadata_enhanced(combined_text)
+        metadata = await limited(_call_openai_final_metadata_enhanced(client, combined_text))
+        report()
+        return metadata
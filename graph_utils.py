@@ -1,17 +1,65 @@
 from pyvis.network import Network
 import streamlit as st
 
-def visualize_knowledge_graph(db):
-    """PyVisを使ってナレッジDBのグラフを可視化する"""
-    nodes = db["graph"]["nodes"]
-    edges = db["graph"]["edges"]
+# これを超えるノード数では、ブラウザ側の物理演算レイアウトが重くなるため無効にする
+PHYSICS_MAX_NODES = 500
+# グラフHTMLのキャッシュに保持する件数（古い版のHTMLを溜め込まないよう少数に抑える）
+GRAPH_HTML_CACHE_ENTRIES = 4
+
+def _set_nodes_edges(net, graph):
+    """
+    add_node/add_edgeを介さず、PyVis(0.3系)の内部リストへノード・エッジを直接設定する。
+    add_edgeは無向グラフで既存エッジを毎回全走査するため、エッジ数に対して二乗の時間がかかる。
+    同じノード対のエッジは最初の1本だけ残す（add_edgeと同じ挙動）。
+    """
+    net.nodes = [
+        {"id": n["id"], "label": n["label"], "title": f"{n['label']} (group: {n['group']})", "group": n["group"], "shape": "dot"}
+        for n in graph["nodes"]
+    ]
+    net.node_ids = [n["id"] for n in net.nodes]
+    net.node_map = {n["id"]: n for n in net.nodes}
+    seen_pairs = set()
+    net.edges = []
+    for e in graph["edges"]:
+        pair = frozenset((e["source"], e["target"]))
+        if pair not in seen_pairs:
+            seen_pairs.add(pair)
+            net.edges.append({"from": e["source"], "to": e["target"], "title": e["label"]})
+
+@st.cache_data(show_spinner=False, max_entries=GRAPH_HTML_CACHE_ENTRIES)
+def _build_graph_html(graph):
+    """グラフ(nodes/edges)の内容をキーにHTMLをキャッシュする（毎回グラフ全体をハッシュする）"""
+    return _render_graph_html(graph)
+
+@st.cache_data(show_spinner=False, max_entries=GRAPH_HTML_CACHE_ENTRIES)
+def _build_versioned_graph_html(version, _graph):
+    """グラフの版(version)だけをキーにHTMLをキャッシュする（_graph はハッシュしない）"""
+    return _render_graph_html(_graph)
+
+def _render_graph_html(graph):
+    """グラフ(nodes/edges)からPyVisのHTMLを生成する"""
     net = Network(height="600px", width="100%", directed=False)
-    for n in nodes:
-        net.add_node(n["id"], label=n["label"], title=f"{n['id']} (group: {n['group']})", group=n["group"])
-    for e in edges:
-        net.add_edge(e["source"], e["target"], title=e["label"])
+    if hasattr(net, "node_map"):
+        _set_nodes_edges(net, graph)
+    else:
+        # node_mapを持たない古いPyVisでは内部構造が異なるため、従来どおり1件ずつ追加する
+        for n in graph["nodes"]:
+            net.add_node(n["id"], label=n["label"], title=f"{n['label']} (group: {n['group']})", group=n["group"])
+        for e in graph["edges"]:
+            net.add_edge(e["source"], e["target"], title=e["label"])
     net.force_atlas_2based()
-    net.save_graph("graph.html")
-    with open("graph.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-        st.components.v1.html(html_content, height=600, scrolling=True)
+    if len(graph["nodes"]) > PHYSICS_MAX_NODES:
+        net.toggle_physics(False)
+    # ファイルを介さずメモリ上でHTMLを生成する（同時アクセス時のgraph.htmlの競合も避ける）
+    return net.generate_html(notebook=False)
+
+def visualize_knowledge_graph(graph, version=None):
+    """
+    PyVisを使ってナレッジDBのグラフ(db["graph"])を可視化する。
+    version(db["_graph_version"])を渡すと、グラフが変わっていない再実行ではハッシュ計算も省く。
+    """
+    if version is None:
+        html_content = _build_graph_html(graph)
+    else:
+        html_content = _build_versioned_graph_html(version, graph)
+    st.components.v1.html(html_content, height=600, scrolling=True)
@@ -1,47 +1,103 @@
 import os
 import json
-import re
-# PyPDF2の代わりにpdfplumberを使う
-import pdfplumber  
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import openai
+import orjson
 import streamlit as st
 import networkx as nx
-from pyvis.network import Network
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import llm_cache
+from graph_utils import visualize_knowledge_graph as render_graph
+from pdf_utils import extract_text_from_pdf
 
 KNOWLEDGE_DB_FILE = "knowledge_db.json"
 
+# プロンプト設定を外部JSONファイルから読み込む（extraction_functions と同じ設定を使う）
+with open("prompts.json", "rb") as f:
+    prompts = orjson.loads(f.read())
+
+# 部分要約を同時に要求するスレッド数の上限
+MAX_PARALLEL_REQUESTS = prompts.get("max_parallel_requests", 10)
+
 def load_knowledge_db():
     """保存済みのナレッジDB(JSON)を読み込む"""
     if os.path.exists(KNOWLEDGE_DB_FILE):
-        with open(KNOWLEDGE_DB_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(KNOWLEDGE_DB_FILE, "rb") as f:
+            return orjson.loads(f.read())
     else:
         return {"documents": [], "graph": {"nodes": [], "edges": []}}
 
 def save_knowledge_db(db):
-    """ナレッジDBをJSON形式で保存"""
-    with open(KNOWLEDGE_DB_FILE, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
-
-def extract_text_from_pdf(pdf_file) -> str:
     """
-    pdfplumberを使ってPDFファイルからテキストを抽出する関数。
-    文字化けが多い場合はPyPDF2より安定して読めることが多い。
+    ナレッジDBをJSON形式で保存（索引などの "_" 始まりのキーは保存しない）。
+    一時ファイルに書いてから置き換え、書き込み途中で中断しても元のファイルを壊さない。
     """
-    text_list = []
-    # pdf_file は Streamlitのfile_uploader等のFile-likeオブジェクト
-    with pdfplumber.open(pdf_file) as pdf:
-        for page in pdf.pages:
-            # extract_text() でそのページの文字をすべて取得
-            page_text = page.extract_text()
-            if page_text:
-                text_list.append(page_text)
-    return "\n".join(text_list)
+    tmp_path = f"{KNOWLEDGE_DB_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(
+            {k: v for k, v in db.items() if not k.startswith("_")},
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        ))
+    os.replace(tmp_path, KNOWLEDGE_DB_FILE)
 
 # 以下、以降の関数は従来のまま据え置き
 # call_openai_for_metadata, update_knowledge_db, visualize_knowledge_graph など
 # ...
 
+# プロンプトの固定部分（本文の前後）。呼び出しごとにテンプレートを組み立て直さない
+_SINGLE_CHUNK_PROMPT_PREFIX = """
+以下の特許文書テキストを読み、
+(1) 全体の要約
+(2) 主なキーワード (箇条書き)
+(3) 関係エンティティ (発明者や対象分野など)
+を **JSON形式のみ**で返してください。
+
+出力形式は以下に必ず従ってください。それ以外の文章や注釈は一切書かないでください:
+
+{
+  "summary": "<string>",
+  "keywords": ["<string>", ...],
+  "entities": {"<entity_key>": "<entity_value>", ...}
+}
+
+テキスト:
+"""
+_SINGLE_CHUNK_PROMPT_SUFFIX = "\n"
+
+_PARTIAL_SUMMARY_PROMPT_PREFIX = """
+以下のテキストを簡潔に150文字以内の1段落で要約し、句点で終えてください。
+
+テキスト:
+"""
+_PARTIAL_SUMMARY_PROMPT_SUFFIX = "\n"
+
+_FINAL_METADATA_PROMPT_PREFIX = """
+以下は複数チャンクを部分要約したテキストを結合したものです。
+これをもとに、
+(1) 全体の要約
+(2) 主なキーワード (箇条書き)
+(3) 関係エンティティ (発明者、対象分野など)
+を **JSON形式のみ**で返してください。絶対に他の文章は出力しないでください。
+
+出力形式:
+{
+  "summary": "<string>",
+  "keywords": ["<string>", ...],
+  "entities": {"<entity_key>": "<entity_value>", ...}
+}
+
+テキスト要約一覧:
+"""
+_FINAL_METADATA_PROMPT_SUFFIX = "\n"
+
+def _cached_chat(**request):
+    """Chat Completionsを呼び、応答本文を返す（同じリクエストはllm_cacheから返す）"""
+    return llm_cache.cached_call(
+        request, lambda: openai.chat.completions.create(**request).choices[0].message.content
+    )
+
 def split_text_with_overlap(text, chunk_size=3000, overlap=200):
     """
     textを chunk_size 文字ずつに分割し、各チャンクを overlap 文字だけ重複させる。
@@ -53,27 +109,14 @@ def split_text_with_overlap(text, chunk_size=3000, overlap=200):
       3つ目チャンク: text[5600 : 8600]
       ...
     """
-    chunks = []
-    start = 0
-    n = len(text)
-
-    while start < n:
-        end = start + chunk_size
-        chunk = text[start:end]
-        chunks.append(chunk)
-        
-        # 次チャンクは (chunk_size - overlap) 進めた位置から
-        start += (chunk_size - overlap)
-
-        if start >= n:
-            break
-
-    return chunks
+    # 各チャンクの開始位置は 0, (chunk_size - overlap), 2*(chunk_size - overlap), ...
+    step = chunk_size - overlap
+    return [text[start:start + chunk_size] for start in range(0, len(text), step)]
 
 def call_openai_for_metadata(text: str):
     """
     長文テキストを複数チャンクに分割し、それぞれを要約→最終的に統合したメタデータ(JSON)を返す。
-    (前回のコードに対して、厳格なJSON生成・デバッグ表示・フォールバック処理を追加)
+    (メタデータはJSONモードで受け取る)
     """
 
     # 1) チャンク分割（3000文字単位、200文字オーバーラップ）
@@ -84,11 +127,19 @@ def call_openai_for_metadata(text: str):
         return _call_openai_single_chunk(chunks[0])
     else:
         # 複数チャンク: (1)部分要約 → (2)再要約(JSON化)
+        # 部分要約は互いに独立なので並行して要求する（mapは入力順に結果を返す）
         partial_summaries = []
-        for i, chunk in enumerate(chunks):
-            with st.spinner(f"チャンク {i+1}/{len(chunks)} を要約中..."):
-                summary_text = _call_openai_partial_summary(chunk)
+        progress = st.progress(0.0, text=f"チャンク 0/{len(chunks)} を要約中...")
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(
+            max_workers=min(MAX_PARALLEL_REQUESTS, len(chunks)),
+            # ワーカースレッドからも st.error を表示できるようにする
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+        ) as executor:
+            for i, summary_text in enumerate(executor.map(_call_openai_partial_summary, chunks)):
                 partial_summaries.append(summary_text)
+                progress.progress((i + 1) / len(chunks), text=f"チャンク {i+1}/{len(chunks)} を要約中...")
+        progress.empty()
 
         combined_text = "\n".join(partial_summaries)
         final_metadata = _call_openai_final_metadata(combined_text)
@@ -97,50 +148,25 @@ def call_openai_for_metadata(text: str):
 def _call_openai_single_chunk(chunk_text: str):
     """
     テキストが3000文字以下のとき、1回で最終的なJSONメタデータを出す。
-    (厳密にJSON出力を促し、パース時に失敗したらフォールバック)
+    (応答はJSONモードで受け取る。API呼び出しに失敗した場合は最低限の構造だけ返す)
     """
-    # Markdownコードブロック + JSONフォーマット指示
-    prompt_for_final = f"""
-以下の特許文書テキストを読み、
-(1) 全体の要約
-(2) 主なキーワード (箇条書き)
-(3) 関係エンティティ (発明者や対象分野など)
-を **JSON形式のみ**で返してください。
-
-出力形式は以下に必ず従ってください。それ以外の文章や注釈は一切書かないでください:
-
-\`\`\`json
-{{
-  "summary": "<string>",
-  "keywords": ["<string>", ...],
-  "entities": {{"<entity_key>": "<entity_value>", ...}}
-}}
-\`\`\`
-
-テキスト:
-{chunk_text}
-"""
+    # JSONフォーマット指示（応答はJSONモードで受け取る）
+    prompt_for_final = _SINGLE_CHUNK_PROMPT_PREFIX + chunk_text + _SINGLE_CHUNK_PROMPT_SUFFIX
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        content = _cached_chat(
+            model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "あなたは優秀な特許アナリストです。"},
                 {"role": "user", "content": prompt_for_final}
             ],
             # max_tokensを十分に確保
             max_tokens=2000,
-            temperature=0.2
+            temperature=0.2,
+            # JSONモード: 応答は必ずパース可能なJSONオブジェクトになる
+            response_format={"type": "json_object"}
         )
-        result_text = response.choices[0].message["content"].strip()
-
-        # デバッグ表示 (モデルからの生文字列を確認)
-        st.write("【DEBUG】Single Chunk 生出力:")
-        st.write(result_text)
-
-        # JSONパースを試みる
-        metadata = _extract_json_from_string(result_text)
-        return metadata
+        return _loads_json(content)
 
     except Exception as e:
         st.error(f"OpenAI APIエラー（single chunk）: {e}")
@@ -150,23 +176,23 @@ def _call_openai_partial_summary(chunk_text: str):
     """
     チャンクごとに「短い要約テキスト」を生成する（JSONではなく文字列）。
     """
-    prompt_for_chunk = f"""
-以下のテキストを簡潔に200文字以内で要約してください。
-
-テキスト:
-{chunk_text}
-"""
+    prompt_for_chunk = _PARTIAL_SUMMARY_PROMPT_PREFIX + chunk_text + _PARTIAL_SUMMARY_PROMPT_SUFFIX
     try:
-        response = openai.ChatCompletion.create(
+        content = _cached_chat(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "あなたは優秀な要約アシスタントです。"},
                 {"role": "user", "content": prompt_for_chunk}
             ],
-            max_tokens=1000,
-            temperature=0.2
+            max_tokens=200,
+            # 1段落の要約なので、空行やコードブロックが始まったら生成を打ち切る
+            stop=["\n\n", "```"],
+            temperature=0.2,
+            top_p=1,
+            presence_penalty=0,
+            frequency_penalty=0
         )
-        summary = response.choices[0].message["content"].strip()
+        summary = content.strip()
         return summary
     except Exception as e:
         st.error(f"OpenAI APIエラー（部分要約）: {e}")
@@ -175,78 +201,35 @@ def _call_openai_partial_summary(chunk_text: str):
 def _call_openai_final_metadata(combined_text: str):
     """
     部分要約を結合した combined_text から、最終的なメタデータ(JSON)を生成。
-    厳格なJSON出力を促し、失敗時はフォールバック処理。
+    応答はJSONモードで受け取り、API呼び出しに失敗した場合は最低限の構造だけ返す。
     """
-    prompt_for_final = f"""
-以下は複数チャンクを部分要約したテキストを結合したものです。
-これをもとに、
-(1) 全体の要約
-(2) 主なキーワード (箇条書き)
-(3) 関係エンティティ (発明者、対象分野など)
-を **JSON形式のみ**で返してください。絶対に他の文章は出力しないでください。
-
-出力形式:
-\`\`\`json
-{{
-  "summary": "<string>",
-  "keywords": ["<string>", ...],
-  "entities": {{"<entity_key>": "<entity_value>", ...}}
-}}
-\`\`\`
-
-テキスト要約一覧:
-{combined_text}
-"""
+    prompt_for_final = _FINAL_METADATA_PROMPT_PREFIX + combined_text + _FINAL_METADATA_PROMPT_SUFFIX
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        content = _cached_chat(
+            model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "あなたは優秀な特許アナリストです。"},
                 {"role": "user", "content": prompt_for_final}
             ],
             # max_tokensを十分に確保
             max_tokens=2000,
-            temperature=0.2
+            temperature=0.2,
+            # JSONモード: 応答は必ずパース可能なJSONオブジェクトになる
+            response_format={"type": "json_object"}
         )
-        result_text = response.choices[0].message["content"].strip()
-
-        # デバッグ表示 (モデルからの生文字列を確認)
-        st.write("【DEBUG】Final Metadata 生出力:")
-        st.write(result_text)
-
-        # JSONパースを試みる
-        metadata = _extract_json_from_string(result_text)
-        return metadata
+        return _loads_json(content)
 
     except Exception as e:
         st.error(f"OpenAI APIエラー（最終メタデータ）: {e}")
         # 失敗時は最低限の構造だけ返す
         return {"summary": "", "keywords": [], "entities": {}}
 
-def _extract_json_from_string(text: str):
-    """
-    モデル出力から、Markdownの```json ...```を切り出してパース。
-    フォールバックとして、直接json.loads()も試す。
-    """
-    # 1) 正規表現で ```json ... ``` 形式を探す
-    pattern = r"```json\s*(.*?)\s*```"
-    match = re.search(pattern, text, flags=re.DOTALL)
-    if match:
-        code_block = match.group(1).strip()
-        try:
-            return json.loads(code_block)
-        except Exception:
-            pass  # 失敗したら次のフォールバックへ
-
-    # 2) 直接text全体をjson.loadsしてみる
-    #    (ユーザーが余計な文章を出さずにそのまま {} を返す場合など)
+def _loads_json(text: str):
+    """orjsonでパースし、orjsonが受け付けない表記(NaN等)のみ標準のjsonで読み直す"""
     try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
         return json.loads(text)
-    except Exception as e:
-        st.error(f"JSONパース失敗: {e}")
-        # 最終的に失敗したら最低限の構造だけ返す
-        return {"summary": "", "keywords": [], "entities": {}}
-
 
 def update_knowledge_db(db, metadata, original_text):
     """
@@ -271,55 +254,34 @@ def update_knowledge_db(db, metadata, original_text):
     #    - ここではドキュメントのIDとキーワードを結ぶ簡易的なモデル
     keywords = metadata.get("keywords", [])
 
+    # nodes/edges と同じ内容のNetworkXグラフ（存在確認をO(1)で行うため、初回だけ作って使い回す）
+    # エッジのキーにはラベルを使い、同一の (source, target, label) は1本にまとめる
+    if "_graph" not in db:
+        graph = nx.MultiDiGraph()
+        graph.add_nodes_from((n["id"], n) for n in db["graph"]["nodes"])
+        graph.add_edges_from((e["source"], e["target"], e["label"], e) for e in db["graph"]["edges"])
+        db["_graph"] = graph
+    graph = db["_graph"]
+
     # docノードが未存在なら追加
-    if doc_id not in [n["id"] for n in db["graph"]["nodes"]]:
-        db["graph"]["nodes"].append({
-            "id": doc_id, "label": doc_id, "group": "document"
-        })
+    if doc_id not in graph:
+        node = {"id": doc_id, "label": doc_id, "group": "document"}
+        db["graph"]["nodes"].append(node)
+        graph.add_node(doc_id, **node)
 
     # キーワードをノード化
     for kw in keywords:
-        if kw not in [n["id"] for n in db["graph"]["nodes"]]:
-            db["graph"]["nodes"].append({
-                "id": kw, "label": kw, "group": "keyword"
-            })
-        db["graph"]["edges"].append({
-            "source": doc_id,
-            "target": kw,
-            "label": "has_keyword"
-        })
+        if kw not in graph:
+            node = {"id": kw, "label": kw, "group": "keyword"}
+            db["graph"]["nodes"].append(node)
+            graph.add_node(kw, **node)
+        if not graph.has_edge(doc_id, kw, key="has_keyword"):
+            edge = {"source": doc_id, "target": kw, "label": "has_keyword"}
+            db["graph"]["edges"].append(edge)
+            graph.add_edge(doc_id, kw, key="has_keyword", **edge)
 
     return db
 
 def visualize_knowledge_graph(db):
-    """PyVisでナレッジDBのグラフを描画する"""
-    nodes = db["graph"]["nodes"]
-    edges = db["graph"]["edges"]
-
-    net = Network(height="600px", width="100%", directed=False)
-
-    # ノード追加
-    for n in nodes:
-        net.add_node(
-            n["id"],
-            label=n["label"],
-            title=f"{n['id']} (group: {n['group']})",
-            group=n["group"]
-        )
-
-    # エッジ追加
-    for e in edges:
-        net.add_edge(
-            e["source"],
-            e["target"],
-            title=e["label"]
-        )
-
-    # 物理演算によるレイアウト
-    net.force_atlas_2based()
-    net.save_graph("graph.html")
-
-    # 作成したHTMLをStreamlitで描画
-    with open("graph.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-        st.components.v1.html(html_content, height=600, scrolling=True)
+    """PyVisでナレッジDBのグラフを描画する（HTMLはファイルを介さずメモリ上で生成する）"""
+    render_graph(db["graph"])
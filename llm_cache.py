@@ -0,0 +1,90 @@
+import hashlib
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import closing
+
+import orjson
+
+# OpenAI APIの応答キャッシュ。同じリクエスト(モデル・パラメータ・メッセージが同一)の再送を省く
+LLM_CACHE_DB = "llm_cache.sqlite"
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+
+_LOCK = threading.Lock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    response BLOB NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+def _connect():
+    conn = sqlite3.connect(LLM_CACHE_DB, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+def request_key(request):
+    """リクエスト(dict)から決まるキャッシュキー（キー順に依存しないSHA-256）"""
+    return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def get(key):
+    """キャッシュ済みの応答を返す。無い/期限切れの場合はNone"""
+    with _LOCK, closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT response FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+    if row is None:
+        return None
+    return orjson.loads(row[0])
+
+def put(key, response, ttl=DEFAULT_TTL_SECONDS):
+    """応答(JSONに変換できる値)を ttl 秒間キャッシュする"""
+    with _LOCK, closing(_connect()) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, response, expires_at) VALUES (?, ?, ?)",
+            (key, orjson.dumps(response), time.time() + ttl)
+        )
+
+def cached_call(request, call, ttl=DEFAULT_TTL_SECONDS):
+    """
+    request に対する応答がキャッシュにあればそれを返し、無ければ call() を呼んで保存する。
+    call() が例外を送出した場合やNoneを返した場合はキャッシュしない。
+    """
+    key = request_key(request)
+    response = get(key)
+    if response is None:
+        response = call()
+        if response is not None:
+            put(key, response, ttl)
+    return response
+
+async def cached_call_async(request, call, ttl=DEFAULT_TTL_SECONDS):
+    """cached_call の非同期版（call はコルーチン関数）"""
+    key = request_key(request)
+    response = get(key)
+    if response is None:
+        response = await call()
+        if response is not None:
+            put(key, response, ttl)
+    return response
+
+def clear_cache(expired_only=False):
+    """キャッシュを削除する（expired_only=True なら期限切れの分だけ）。削除件数を返す"""
+    with _LOCK, closing(_connect()) as conn:
+        if expired_only:
+            cursor = conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        else:
+            cursor = conn.execute("DELETE FROM cache")
+        return cursor.rowcount
+
+if __name__ == "__main__":
+    # python llm_cache.py clear [--expired]
+    if sys.argv[1:2] != ["clear"]:
+        print("usage: python llm_cache.py clear [--expired]")
+        sys.exit(1)
+    deleted = clear_cache(expired_only="--expired" in sys.argv[2:])
+    print(f"{deleted} 件のキャッシュを削除しました")
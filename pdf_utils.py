@@ -0,0 +1,64 @@
+import io
+import logging
+
+import pymupdf
+import pdfplumber
+import pypdfium2 as pdfium
+
+logger = logging.getLogger(__name__)
+
+def extract_text_from_pdf(pdf_file) -> str:
+    """
+    PyMuPDFを使ってPDFファイルからテキストを抽出する関数。
+    PyMuPDFで開けないPDFの場合のみ、pypdfium2(PDFium)にフォールバックし、
+    それでも開けない・テキストが取れない場合はpdfplumberで抽出する。
+    全ページを連結した文字列を返す（トークン上限での切り詰め・キャッシュキー・保存する全文が
+    いずれも文書全体を前提とするため、ページ単位では返さない）。
+    """
+    # pdf_file は Streamlitのfile_uploader等のFile-likeオブジェクト
+    # (再実行時に読み取り位置が残っているため、必ず先頭に戻してから読む)
+    pdf_file.seek(0)
+    data = pdf_file.read()
+    try:
+        doc = pymupdf.open(stream=data, filetype="pdf")
+    except Exception as e:
+        logger.warning("PyMuPDFでPDFを開けないため、pypdfium2で抽出します: %s", e)
+        return _extract_text_with_fallback(data)
+    # PyMuPDFは単一スレッド前提で、抽出中もGILを保持するため、スレッドで並列化しても速くならない
+    # (複数スレッドからの利用も公式に非推奨)。ページは逐次抽出し、スレッド数の設定も持たない
+    with doc:
+        return "\n".join(page.get_text("text") for page in doc)
+
+def _extract_text_with_fallback(data: bytes) -> str:
+    """PyMuPDFで開けないPDFの抽出（pypdfium2 → pdfplumber の順に試す）"""
+    try:
+        text = _extract_text_with_pdfium(data)
+    except Exception as e:
+        logger.warning("pypdfium2でPDFを開けないため、pdfplumberで抽出します: %s", e)
+        return _extract_text_with_pdfplumber(data)
+    if not text.strip():
+        logger.warning("pypdfium2でテキストを抽出できないため、pdfplumberで抽出します")
+        return _extract_text_with_pdfplumber(data)
+    return text
+
+def _extract_text_with_pdfium(data: bytes) -> str:
+    """
+    pypdfium2(PDFium)による抽出。ページ・テキストページは使い終わったら閉じる。
+    PDFiumは文書が別でもスレッドセーフではないため、並列化せず逐次抽出する。
+    """
+    pdf = pdfium.PdfDocument(data)
+    try:
+        texts = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            texts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return "\n".join(texts)
+    finally:
+        pdf.close()
+
+def _extract_text_with_pdfplumber(data: bytes) -> str:
+    """pdfplumberによるフォールバック抽出"""
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        return "\n".join(page.extract_text() or "" for page in pdf.pages)